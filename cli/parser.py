@@ -70,5 +70,12 @@ def get_argument_parser():
         metavar='IMAGEFILE',
         help="Path to the ISO you want to modify",
     )
+    subparser_inject.add_argument(
+        "--patch",
+        action='store_true',
+        dest='patch',
+        help="Patch the files into a copy of the ISO instead of extracting "
+             "and repacking it (experimental, requires xorriso 1.5.4 or newer)",
+    )
 
     return mainparser
@@ -1,9 +1,11 @@
 """A collection of general utilities, not specific to any module."""
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from crypt import crypt, METHOD_SHA512
 from getpass import getpass
-from os import remove, rename
+from os import remove, rename, scandir
 from pathlib import Path
+from shutil import which
 from subprocess import run, STDOUT, PIPE
 from sys import exit
 from tempfile import TemporaryDirectory
@@ -52,13 +54,11 @@ def assert_system_dependencies_installed():
     """
 
     _REQUIRED_PROGRAMS = [
-        "xorriso", "gpg", "cpio", "sha512sum",
+        "xorriso", "gpg", "sha512sum",
     ]
 
     for program in _REQUIRED_PROGRAMS:
-        try:
-            run(["command", "-v", program], shell=True, check=True)
-        except subprocess.CalledProcessError:
+        if which(program) is None:
             raise MissingDependencyError(
                 f"Program not installed or not in $PATH: "
                 f"'{program}'."
@@ -67,7 +67,8 @@ def assert_system_dependencies_installed():
 def find_all_files_under(parent_dir):
     """Recursively finds all files anywhere under the specified directory.
 
-    Returns a list of absolute Path objects. Symlinks are ignored.
+    Returns a list of absolute Path objects, ordered by inode number.
+    Symlinks are ignored.
 
     Parameters
     ----------
@@ -85,22 +86,51 @@ def find_all_files_under(parent_dir):
 
     """
 
-    if "~" in str(parent_dir):
-        parent_dir = Path(parent_dir).expanduser()
-    parent_dir = Path(parent_dir).resolve()
+    parent_dir = Path(parent_dir).expanduser().resolve()
 
     if not parent_dir.is_dir():
         raise NotADirectoryError(f"No such directory: '{parent_dir}'.")
 
-    files = []
+    def scan_directory(directory):
+        """Returns the files and subdirectories found within the directory."""
+        directory_files = []
+        subdirectories = []
+        with scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    directory_files.append((entry.inode(), entry.path))
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+        return directory_files, subdirectories
 
-    for subpath in parent_dir.iterdir():
-        if subpath.is_file():
-            files.append(subpath.resolve())
-        elif not subpath.is_symlink() and subpath.is_dir():
-            files += find_all_files_under(subpath)
+    files = []
 
-    return files
+    # os.scandir's entries cache the file type read along with the directory
+    # listing, which saves a stat() call per entry compared to Path.iterdir().
+    # Directories are scanned in parallel, as os.scandir releases the GIL
+    # while waiting for the filesystem.
+    # Paths are handled as strings and only converted to Path objects once.
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pending_scans = {executor.submit(scan_directory, str(parent_dir))}
+        while pending_scans:
+            finished_scans, pending_scans = wait(
+                pending_scans, return_when=FIRST_COMPLETED
+            )
+            for finished_scan in finished_scans:
+                directory_files, subdirectories = finished_scan.result()
+                files += directory_files
+                pending_scans.update(
+                    executor.submit(scan_directory, subdirectory)
+                    for subdirectory in subdirectories
+                )
+
+    # sorting by inode number approximates the files' order on disk, which
+    # makes reading all of them in this order close to sequential.
+    # DirEntry.inode() is known from the directory listing without a stat().
+    # no need to resolve() the files: the parent directory is already
+    # resolved, and no symlinks are followed below it
+    files.sort()
+    return [Path(file) for _, file in files]
 
 
 def trim_text_file(path_to_input_file, substring):
@@ -125,9 +155,7 @@ def trim_text_file(path_to_input_file, substring):
     if "\n" in substring or len(substring) == 0:
         return
 
-    if "~" in str(path_to_input_file):
-        path_to_input_file = Path(path_to_input_file).expanduser()
-    path_to_input_file = Path(path_to_input_file).resolve()
+    path_to_input_file = Path(path_to_input_file).expanduser().resolve()
 
     if not path_to_input_file.is_file():
         raise FileNotFoundError(f"No such file: '{path_to_input_file}'.")
@@ -148,9 +176,7 @@ def trim_text_file(path_to_input_file, substring):
 def file_is_empty(path_to_input_file):
     """Checks whether the input file is empty or not."""
 
-    if "~" in str(path_to_input_file):
-        path_to_input_file = Path(path_to_input_file).expanduser()
-    path_to_input_file = Path(path_to_input_file).resolve()
+    path_to_input_file = Path(path_to_input_file).expanduser().resolve()
 
     if not path_to_input_file.is_file():
         raise FileNotFoundError(f"No such file: '{path_to_input_file}'.")
@@ -176,9 +202,7 @@ def download_and_verify_debian_iso(path_to_output_file, printer=None):
         A CLI printer to be used for output.
     """
 
-    if "~" in str(path_to_output_file):
-        path_to_output_file = Path(path_to_output_file).expanduser()
-    path_to_output_file = Path(path_to_output_file).resolve()
+    path_to_output_file = Path(path_to_output_file).expanduser().resolve()
 
     if path_to_output_file.is_file():
         raise FileExistsError(
@@ -35,13 +35,8 @@ def assert_detached_signature_is_valid(
         If the gpg verification detects a bad signature.
     """
 
-    if '~' in str(path_to_input_file):
-        path_to_input_file = Path(path_to_input_file).expanduser()
-    path_to_input_file = Path(path_to_input_file).resolve()
-
-    if '~' in str(path_to_signature_file):
-        path_to_signature_file = Path(path_to_signature_file).expanduser()
-    path_to_signature_file = Path(path_to_signature_file).resolve()
+    path_to_input_file = Path(path_to_input_file).expanduser().resolve()
+    path_to_signature_file = Path(path_to_signature_file).expanduser().resolve()
 
     if not path_to_input_file.is_file():
         raise FileNotFoundError(
@@ -2,22 +2,49 @@
 
 Image file modification includes extracting ISO archives, adding files to
 initrd-archives contained within the ISO, recalculating md5sum-files
-inside the ISO and rebuilding bootable ISOs from directories on the
-local filesystem.
+inside the ISO, rebuilding bootable ISOs from directories on the
+local filesystem and patching files into copies of existing ISOs.
 
 """
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import gzip
 import hashlib
+import mmap
 import re
 import shutil
+import stat
 import subprocess
 
 from cli.clibella import Printer
 from core.utils import find_all_files_under
 
+# files of at least this size are memory-mapped for hashing
+_MD5_MMAP_THRESHOLD = 10 * 1024 * 1024
+
+# chunk size used for hashing smaller files if hashlib.file_digest() is not
+# available, small enough for each chunk to stay in the CPU cache
+_MD5_READ_CHUNK_SIZE = 128 * 1024
+
+# matches characters not allowed in ISO filesystem names
+_FILESYSTEM_NAME_INVALID_CHAR_REGEX = re.compile(r"[^\w .-]")
+
+# xorriso is called via its absolute path, with close_fds=False: only then
+# python (< 3.13) uses the faster posix_spawn() instead of fork() and exec().
+# No file descriptors leak into it though, as python creates non-inheritable
+# ones by default. Falls back to the bare name if xorriso is not installed,
+# which fails just like before.
+_XORRISO_EXECUTABLE = shutil.which("xorriso") or "xorriso"
+
+# oldest xorriso release providing '-boot_image any replay', used by patch_iso()
+_XORRISO_MIN_PATCHING_VERSION = (1, 5, 4)
+
+# upper bound for the size of an ISO's gtk initrd and md5sum.txt, which are
+# extracted into the overlay directory when patching (about 40 MB together)
+_PATCHED_ISO_FILES_MAX_SIZE = 128 * 1024 * 1024
+
 
 def extract_iso(path_to_output_dir, path_to_input_file):
     """Extracts the contents of the ISO-file into the specified directory.
@@ -45,13 +72,8 @@ def extract_iso(path_to_output_dir, path_to_input_file):
 
     """
 
-    if "~" in str(path_to_output_dir):
-        path_to_output_dir = Path(path_to_output_dir).expanduser()
-    path_to_output_dir = Path(path_to_output_dir).resolve()
-
-    if "~" in str(path_to_input_file):
-        path_to_input_file = Path(path_to_input_file).expanduser()
-    path_to_input_file = Path(path_to_input_file).resolve()
+    path_to_output_dir = Path(path_to_output_dir).expanduser().resolve()
+    path_to_input_file = Path(path_to_input_file).expanduser().resolve()
 
     # check if paths are valid
     if not path_to_output_dir.is_dir():
@@ -63,14 +85,15 @@ def extract_iso(path_to_output_dir, path_to_input_file):
     try:
         subprocess.run(
             [
-                "xorriso",
+                _XORRISO_EXECUTABLE,
                 "-osirrox", "on",
                 "-indev", path_to_input_file,
                 "-extract", "/",
                 path_to_output_dir
             ],
             capture_output=True,
-            check=True
+            check=True,
+            close_fds=False
         )
     except subprocess.CalledProcessError:
         raise RuntimeError(
@@ -78,6 +101,120 @@ def extract_iso(path_to_output_dir, path_to_input_file):
         )
 
 
+def extract_files_from_iso(path_to_output_dir, path_to_input_file, iso_paths):
+    """Extracts only the specified files from the ISO into the directory.
+
+    Each file is extracted to the same path relative to the output directory
+    as it has relative to the ISO's root directory, so that the output
+    directory can later be mapped back onto the ISO's root using patch_iso().
+
+    Parameters
+    ----------
+    path_to_output_dir : str or pathlike object
+        Path to the directory into which the files will be extracted.
+    path_to_input_file : str or pathlike object
+        Path to the ISO file from which the files will be extracted.
+    iso_paths : list containing str
+        Paths of the files to extract, relative to the ISO's root directory.
+
+    Raises
+    ------
+    FileNotFoundError
+        Raised if the input file does not exist or is not a file.
+    NotADirectoryError
+        Raised if the output directory does not exist or is not a directory.
+    RuntimeError
+        Raised if the extraction fails.
+
+    Example
+    -------
+        extract_files_from_iso(
+            "/tmp/isofiles",
+            "/home/myuser/downloads/debian-11.iso",
+            ["md5sum.txt", "install.amd/gtk/initrd.gz"])
+
+    """
+
+    path_to_output_dir = Path(path_to_output_dir).expanduser().resolve()
+    path_to_input_file = Path(path_to_input_file).expanduser().resolve()
+
+    # check if paths are valid
+    if not path_to_output_dir.is_dir():
+        raise NotADirectoryError(f"No such directory: '{path_to_output_dir}'.")
+    if not path_to_input_file.is_file():
+        raise FileNotFoundError(f"No such file: '{path_to_input_file}'.")
+
+    extract_args = []
+    for iso_path in iso_paths:
+        path_to_output_file = path_to_output_dir/iso_path
+        path_to_output_file.parent.mkdir(parents=True, exist_ok=True)
+        extract_args += ["-extract", f"/{iso_path}", path_to_output_file]
+
+    # extract files to destination
+    try:
+        subprocess.run(
+            [
+                _XORRISO_EXECUTABLE,
+                "-osirrox", "on",
+                "-indev", path_to_input_file,
+                *extract_args,
+            ],
+            capture_output=True,
+            check=True,
+            close_fds=False
+        )
+    except subprocess.CalledProcessError:
+        raise RuntimeError(
+            f"An error occurred while extracting files from "
+            f"'{path_to_input_file}'."
+        )
+
+
+def _create_cpio_archive(base_dir, relative_path_to_input_file):
+    """Returns a cpio archive in the 'newc' format containing the input file.
+
+    The file is stored under its path relative to the base directory, just
+    like 'cpio -H newc -o' would if called from within the base directory.
+    Source: https://www.kernel.org/doc/html/latest/driver-api/early-userspace/buffer-format.html
+
+    """
+
+    def create_cpio_entry(name, inode, file_stat, data):
+        name = name.encode() + b"\0"
+        fields = [
+            inode, file_stat.st_mode, 0, 0, 1,
+            int(file_stat.st_mtime), len(data), 0, 0, 0, 0, len(name), 0,
+        ]
+        # each header field holds exactly 8 hex digits, larger values would
+        # silently shift all following fields
+        if any(field > 0xFFFFFFFF for field in fields):
+            raise RuntimeError(f"Cannot be stored in a cpio archive: "
+                               f"'{relative_path_to_input_file}'.")
+        header = b"070701" + b"".join(b"%08X" % field for field in fields)
+        # the name and data are each padded to a multiple of 4 bytes
+        return (
+            header + name + b"\0" * (-(len(header) + len(name)) % 4)
+            + data + b"\0" * (-len(data) % 4)
+        )
+
+    path_to_input_file = Path(base_dir)/relative_path_to_input_file
+    file_stat = path_to_input_file.stat()
+    trailer_stat = os.stat_result((0,) * 10)
+
+    # the file's real inode number may exceed 32 bits (e.g. on tmpfs or
+    # btrfs), and the kernel only needs inode numbers to detect hardlinks of
+    # files with multiple links, so the single file simply gets inode 1
+    return (
+        create_cpio_entry(
+            str(relative_path_to_input_file),
+            1,
+            file_stat,
+            path_to_input_file.read_bytes(),
+        )
+        + create_cpio_entry("TRAILER!!!", 0, trailer_stat, b"")
+    )
+
+
 def append_file_contents_to_initrd_archive(
         path_to_initrd_archive,
         base_dir,
@@ -85,8 +222,8 @@ def append_file_contents_to_initrd_archive(
 ):
     """Appends the input file to the specified initrd archive.
 
-    The initrd archive is extracted, the input file is appended, and
-    the initrd is repacked again.
+    A gzip-compressed cpio archive containing the input file is appended to
+    the initrd archive, whose existing contents are left untouched.
     Source: https://wiki.debian.org/DebianInstaller/Preseed/EditIso#Adding_a_Preseed_File_to_the_Initrd
 
     Parameters
@@ -114,9 +251,7 @@ def append_file_contents_to_initrd_archive(
 
     """
 
-    if "~" in str(path_to_initrd_archive):
-        path_to_initrd_archive = Path(path_to_initrd_archive).expanduser()
-    path_to_initrd_archive = Path(path_to_initrd_archive).resolve()
+    path_to_initrd_archive = Path(path_to_initrd_archive).expanduser().resolve()
 
     # check if initrd file exists and has the correct name
     if not path_to_initrd_archive.is_file():
@@ -129,52 +264,125 @@ def append_file_contents_to_initrd_archive(
     path_to_initrd_archive.chmod(0o644)
     path_to_initrd_archive.parent.chmod(0o755)
 
-    path_to_initrd_extracted = path_to_initrd_archive.with_suffix("")
+    # create a compressed cpio archive containing the input file
+    appended_archive = gzip.compress(
+        _create_cpio_archive(base_dir, relative_path_to_input_file),
+        mtime=0,
+    )
 
-    # extract archive in-place
-    with gzip.open(path_to_initrd_archive, "rb") as file_gz:
-        with open(path_to_initrd_extracted, "wb") as file_raw:
-            shutil.copyfileobj(file_gz, file_raw)
-    path_to_initrd_archive.unlink()
+    # the kernel unpacks concatenated, individually compressed cpio archives,
+    # so the new archive is simply appended to the initrd as it is, without
+    # decompressing or recompressing the initrd's existing contents
+    with open(path_to_initrd_archive, "ab") as initrd_file:
+        initrd_file.write(appended_archive)
 
-    try:
-        # append contents of input_file to extracted archive using cpio
-        # NOTE cpio must be called from within the input file's parent
-        # directory, and the input file's name is piped into it
-        completed_process = subprocess.Popen(
-            [
-                "cpio", "-H", "newc", "-o", "-A",
-                "-F", str(path_to_initrd_extracted.resolve())
-            ],
-            cwd=base_dir,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        completed_process.communicate(
-            input=str(relative_path_to_input_file).encode()
-        )
+    # revert write permissions from the archive and its parent dir
+    path_to_initrd_archive.chmod(0o444)
+    path_to_initrd_archive.parent.chmod(0o555)
 
-    except subprocess.CalledProcessError:
-        raise RuntimeError(
-            f"Failed while appending contents of '{relative_path_to_input_file}' to "
-            f"'{path_to_initrd_archive}'."
-        )
 
-    # repack archive
-    with gzip.open(path_to_initrd_archive, "wb") as file_gz:
-        with open(path_to_initrd_extracted, "rb") as file_raw:
-            shutil.copyfileobj(file_raw, file_gz)
-    path_to_initrd_extracted.unlink()
+def _new_md5_hash():
+    """Returns a new md5 hash object, not flagged as used for security.
 
-    # revert write permissions from repacked archive and its parent dir
-    path_to_initrd_archive.chmod(0o444)
-    path_to_initrd_archive.parent.chmod(0o555)
+    The md5 hashes only serve as integrity checks of the ISO's files, which
+    keeps them available on FIPS-enabled systems.
+    """
+    return hashlib.new("md5", usedforsecurity=False)
+
+
+def _calculate_md5_hash(path_to_input_file):
+    """Returns the hex digest of the input file's md5 hash."""
+
+    # the file is read unbuffered, as it is consumed in large blocks anyway
+    with open(path_to_input_file, "rb", buffering=0) as file:
+        if os.fstat(file.fileno()).st_size >= _MD5_MMAP_THRESHOLD:
+            # hash large files straight from the page cache
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # let the kernel read ahead aggressively
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                md5hash = _new_md5_hash()
+                md5hash.update(mm)
+                return md5hash.hexdigest()
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(file, _new_md5_hash).hexdigest()
+        # python < 3.11: read in chunks rather than loading the whole file
+        md5hash = _new_md5_hash()
+        while chunk := file.read(_MD5_READ_CHUNK_SIZE):
+            md5hash.update(chunk)
+        return md5hash.hexdigest()
+
+
+def _calculate_md5_hashes(paths_to_input_files):
+    """Returns the hex digests of the input files' md5 hashes, in order.
+
+    The files are hashed in parallel: hashlib releases the GIL while
+    digesting, so reading and hashing of multiple files can overlap.
+    """
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(_calculate_md5_hash, paths_to_input_files))
+
+
+def _read_md5sums_file(path_to_md5sum_file):
+    """Parses an md5sum.txt file.
+
+    Returns a dict mapping each file path to its md5 hash, along with the
+    prefix of the file paths: Debian prefixes all paths with './'.
+    """
+
+    md5hashes = {}
+    path_prefix = ""
+    for line in Path(path_to_md5sum_file).read_text().splitlines():
+        md5hash, relative_path = line.split("  ", 1)
+        if relative_path.startswith("./"):
+            path_prefix = "./"
+            relative_path = relative_path[2:]
+        md5hashes[relative_path] = md5hash
+
+    return md5hashes, path_prefix
+
+
+def _drop_md5sums_of_removed_paths(md5hashes, removed_paths):
+    """Removes the md5 hashes of the removed files from the dict in-place.
+
+    Each removed path is either a file or a whole directory, relative to the
+    ISO's root directory. Paths missing from the dict are ignored.
+    """
+
+    for removed_path in removed_paths:
+        removed_path = str(removed_path).strip("/")
+        for relative_path in list(md5hashes):
+            if (relative_path == removed_path
+                    or relative_path.startswith(removed_path + "/")):
+                del md5hashes[relative_path]
+
+
+def _write_md5sums_file(path_to_md5sum_file, md5hashes, path_prefix=""):
+    """Writes the md5 hashes into the md5sum.txt file, sorted by file path.
+
+    The md5hashes dict maps each file path to its md5 hash.
+    """
+
+    # structure: '<md5_hash>  path/to/file/relative/to/iso_root'
+    # with one line per file. Note the two spaces between hash and filepath!
+    # The lines are sorted so that the output is reproducible, and written
+    # using a single call.
+    md5sum_text = "".join(
+        f"{md5hashes[relative_path]}  {path_prefix}{relative_path}\n"
+        for relative_path in sorted(md5hashes)
+    )
+
+    with open(path_to_md5sum_file, "w") as md5sum_file:
+        md5sum_file.write(md5sum_text)
 
 
 def regenerate_iso_md5sums_file(path_to_extracted_iso_root):
     """Recalculates and rewrites the md5sum.txt file for the extracted ISO.
 
+    To update md5sum.txt for a few changed files only, use
+    update_iso_md5sums_file() instead.
+
     Source: https://wiki.debian.org/DebianInstaller/Preseed/EditIso#Regenerating_md5sum.txt
 
     Parameters
@@ -197,9 +405,7 @@ def regenerate_iso_md5sums_file(path_to_extracted_iso_root):
 
     """
 
-    if "~" in str(path_to_extracted_iso_root):
-        path_to_extracted_iso_root = Path(path_to_extracted_iso_root).expanduser()
-    path_to_extracted_iso_root = Path(path_to_extracted_iso_root).resolve()
+    path_to_extracted_iso_root = Path(path_to_extracted_iso_root).expanduser().resolve()
 
     # check if input path exists
     if not path_to_extracted_iso_root.is_dir():
@@ -216,32 +422,94 @@ def regenerate_iso_md5sums_file(path_to_extracted_iso_root):
     # remove original md5sum.txt
     path_to_md5sum_file.unlink()
 
-    # create a new md5sum file:
-    # structure: '<md5_hash>  path/to/file/relative/to/iso_root'
-    # with one line per file, for each file anywhere under the ISO root folder.
-    # Note the two spaces between hash and filepath!
-
-    # find all files
+    # hash all files anywhere under the ISO root folder
     subpaths = find_all_files_under(path_to_extracted_iso_root)
+    md5hashes = dict(zip(
+        (
+            str(subpath.relative_to(path_to_extracted_iso_root))
+            for subpath in subpaths
+        ),
+        _calculate_md5_hashes(subpaths),
+    ))
 
-    with open(path_to_md5sum_file, "w") as md5sum_file:
-        for subpath in subpaths:
-            md5hash = hashlib.md5()
-            with open(subpath, "rb") as file:
-                # calculate md5 hash
-                md5hash.update(file.read())
-            md5sum_file.write(
-                md5hash.hexdigest()
-                + "  "
-                + str(subpath.relative_to(path_to_extracted_iso_root))
-                + "\n"
-            )
+    _write_md5sums_file(path_to_md5sum_file, md5hashes)
 
     # revert write permissions from md5sum.txt and its parent dir
     path_to_md5sum_file.chmod(0o444)
     path_to_md5sum_file.parent.chmod(0o555)
 
 
+def update_iso_md5sums_file(
+        path_to_md5sum_file,
+        path_to_overlay_dir,
+        removed_iso_paths=(),
+):
+    """Updates an ISO's md5sum.txt file after patching the ISO.
+
+    The overlay directory contains those files which are added to or replaced
+    within the ISO, at the same paths relative to the overlay directory as
+    they have relative to the ISO's root directory. Only the overlay files
+    are hashed, their lines are added or replaced, and the lines of any
+    removed files are dropped. All other lines are kept as they are.
+
+    Parameters
+    ----------
+    path_to_md5sum_file : str or pathlike object
+        Path to the md5sum.txt file extracted from the ISO. The file is
+        rewritten in-place.
+    path_to_overlay_dir : str or pathlike object
+        Path to the directory containing the added or replaced files.
+    removed_iso_paths : list containing str
+        Paths of files or directories removed from the ISO, relative to the
+        ISO's root directory.
+
+    Raises
+    ------
+    FileNotFoundError
+        Raised if the md5sum file does not exist or is not a file.
+    NotADirectoryError
+        Raised if the overlay directory does not exist or is not a
+        directory.
+
+    Examples
+    --------
+    update_iso_md5sums_file(
+        "/tmp/isofiles/md5sum.txt",
+        "/tmp/isofiles",
+        ["install.amd/xen"])
+
+    """
+
+    path_to_md5sum_file = Path(path_to_md5sum_file).expanduser().resolve()
+    path_to_overlay_dir = Path(path_to_overlay_dir).expanduser().resolve()
+
+    # check if input paths exist
+    if not path_to_md5sum_file.is_file():
+        raise FileNotFoundError(f"No such file: '{path_to_md5sum_file}'.")
+    if not path_to_overlay_dir.is_dir():
+        raise NotADirectoryError(
+            f"No such directory: '{path_to_overlay_dir}'."
+        )
+
+    md5hashes, path_prefix = _read_md5sums_file(path_to_md5sum_file)
+
+    # drop removed files
+    _drop_md5sums_of_removed_paths(md5hashes, removed_iso_paths)
+
+    # hash the files from the overlay, except for md5sum.txt itself
+    subpaths = [
+        subpath for subpath in find_all_files_under(path_to_overlay_dir)
+        if subpath != path_to_md5sum_file
+    ]
+    for subpath, md5hash in zip(subpaths, _calculate_md5_hashes(subpaths)):
+        md5hashes[str(subpath.relative_to(path_to_overlay_dir))] = md5hash
+
+    # make md5sum file temporarily writable
+    path_to_md5sum_file.chmod(0o644)
+    _write_md5sums_file(path_to_md5sum_file, md5hashes, path_prefix)
+    path_to_md5sum_file.chmod(0o444)
+
+
 def extract_mbr_from_iso(path_to_output_file, path_to_source_iso):
     """Extracts the MBR-data from the ISO and writes it into the outputfile.
 
@@ -274,13 +542,8 @@ def extract_mbr_from_iso(path_to_output_file, path_to_source_iso):
 
     """
 
-    if "~" in str(path_to_output_file):
-        path_to_output_file = Path(path_to_output_file).expanduser()
-    path_to_output_file = Path(path_to_output_file).resolve()
-
-    if "~" in str(path_to_source_iso):
-        path_to_source_iso = Path(path_to_source_iso).expanduser()
-    path_to_source_iso = Path(path_to_source_iso)
+    path_to_output_file = Path(path_to_output_file).expanduser().resolve()
+    path_to_source_iso = Path(path_to_source_iso).expanduser()
 
     # make sure output file does not exist already
     if path_to_output_file.exists():
@@ -296,11 +559,24 @@ def extract_mbr_from_iso(path_to_output_file, path_to_source_iso):
             f"Input file is not an image file: '{path_to_source_iso}'.")
 
     # extract the MBR (first 432 Bytes) of the source ISO file
-    with open(path_to_source_iso, mode="r+b") as iso_file:
-        with open(path_to_output_file, mode="w+b") as mbr_file:
+    with open(path_to_source_iso, mode="rb") as iso_file:
+        with open(path_to_output_file, mode="wb") as mbr_file:
             mbr_file.write(iso_file.read(432))
 
 
+def _assert_filesystem_name_is_valid(filesystem_name):
+    """Raises a RuntimeError if the ISO filesystem name contains illegal chars.
+
+    Only alphanumeric, ' ', '.', '_' and '-' are allowed.
+    """
+
+    invalid_char_match = _FILESYSTEM_NAME_INVALID_CHAR_REGEX.search(
+        filesystem_name)
+    if invalid_char_match is not None:
+        raise RuntimeError(f"Invalid character in filesystem name: "
+                           f"'{invalid_char_match.group()[0]}'.")
+
+
 def repack_iso(path_to_output_iso,
                path_to_mbr_data_file,
                path_to_input_files_root_dir,
@@ -351,17 +627,9 @@ def repack_iso(path_to_output_iso,
 
     """
 
-    if "~" in str(path_to_output_iso):
-        path_to_output_iso = Path(path_to_output_iso).expanduser()
-    path_to_output_iso = Path(path_to_output_iso).resolve()
-
-    if "~" in str(path_to_mbr_data_file):
-        path_to_mbr_data_file = Path(path_to_mbr_data_file).expanduser()
-    path_to_mbr_data_file = Path(path_to_mbr_data_file).resolve()
-
-    if "~" in str(path_to_input_files_root_dir):
-        path_to_input_files_root_dir = Path(path_to_input_files_root_dir).expanduser()
-    path_to_input_files_root_dir = Path(path_to_input_files_root_dir).resolve()
+    path_to_output_iso = Path(path_to_output_iso).expanduser().resolve()
+    path_to_mbr_data_file = Path(path_to_mbr_data_file).expanduser().resolve()
+    path_to_input_files_root_dir = Path(path_to_input_files_root_dir).expanduser().resolve()
 
     # make sure output file does not exist yet
     if path_to_output_iso.exists():
@@ -375,23 +643,27 @@ def repack_iso(path_to_output_iso,
         raise NotADirectoryError(f"No such directory: "
                                  f"'{path_to_input_files_root_dir}'.")
 
-    # make sure specified filesystem name contains no illegal characters:
-    # only alphanumeric, ' ', '.', '_' and '-' are allowed.
-    filesystem_name_invalid_char_regex = re.compile(r"[^\w .-]")
-    invalid_char_match = filesystem_name_invalid_char_regex.search(
-        created_iso_filesystem_name)
-    if invalid_char_match is not None:
-        raise RuntimeError(f"Invalid character in filesystem name: "
-                           f"'{invalid_char_match.group()[0]}'.")
+    # make sure specified filesystem name contains no illegal characters
+    _assert_filesystem_name_is_valid(created_iso_filesystem_name)
+
+    # Joliet file names are limited to 64 characters, building the Joliet
+    # tree for longer names needs -joliet-long, which is only passed if needed
+    joliet_args = ["-J"]
+    if any(
+        len(name) > 64
+        for _, dirnames, filenames in os.walk(path_to_input_files_root_dir)
+        for name in dirnames + filenames
+    ):
+        joliet_args.append("-joliet-long")
 
     # repack the ISO using xorriso
     try:
         subprocess.run(
             [
-                "xorriso", "-as", "mkisofs",
+                _XORRISO_EXECUTABLE, "-as", "mkisofs",
                 "-r", "-V", created_iso_filesystem_name,
                 "-o", path_to_output_iso,
-                "-J", "-J", "-joliet-long", "-cache-inodes",
+                *joliet_args, "-cache-inodes",
                 "-isohybrid-mbr", path_to_mbr_data_file,
                 "-b", "isolinux/isolinux.bin",
                 "-c", "isolinux/boot.cat",
@@ -403,6 +675,7 @@ def repack_iso(path_to_output_iso,
             ],
             capture_output=True,
             check=True,
+            close_fds=False,
         )
 
     except subprocess.CalledProcessError:
@@ -410,58 +683,263 @@ def repack_iso(path_to_output_iso,
                            f"'{path_to_input_files_root_dir}'.")
 
 
-def inject_files_into_iso(
-        path_to_output_iso_file,
-        path_to_input_iso_file,
-        iso_filesystem_name="Debian",
-        printer=None,
-):
-    """Injects the specified input files into the specified ISO file.
+def _get_xorriso_version():
+    """Returns the installed xorriso's version as a tuple of ints.
 
-    Extracts the input ISO into a temporary directory, then extracts the input
-    ISO's MBR into a temporary file, then appends the input files to the
-    extracted ISO's initrd, then regenerates the extracted ISO's internal MD5
-    hash list and finally repacks the extracted ISO into the output ISO.
+    Returns None if xorriso cannot be run or its version is not recognized.
+    """
 
-    The input ISO file itself is left unchanged.
-    The output ISO file is newly created.
+    try:
+        result = subprocess.run(
+            [_XORRISO_EXECUTABLE, "-version"],
+            capture_output=True,
+            check=True,
+            close_fds=False,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    # the first line reads like 'xorriso 1.5.4 : RockRidge filesystem ...'
+    version_match = re.search(
+        rb"^xorriso (\d+)\.(\d+)\.(\d+)", result.stdout + result.stderr,
+        re.MULTILINE,
+    )
+    if version_match is None:
+        return None
+    return tuple(int(part) for part in version_match.groups())
+
+
+def xorriso_supports_patching():
+    """Returns True if the installed xorriso can be used by patch_iso()."""
+
+    xorriso_version = _get_xorriso_version()
+    return (xorriso_version is not None
+            and xorriso_version >= _XORRISO_MIN_PATCHING_VERSION)
+
+
+def patch_iso(path_to_output_iso,
+              path_to_input_iso,
+              path_to_overlay_dir,
+              created_iso_filesystem_name,
+              removed_iso_paths=()):
+    """Creates a modified copy of the input ISO without extracting it.
+
+    The files within the overlay directory are added to the input ISO's
+    contents, replacing existing files at the same paths relative to the ISO
+    root. The removed paths (files or whole directories) are deleted, paths
+    which do not exist within the input ISO are ignored. The
+    result is written to the output ISO using xorriso, which copies all
+    unmodified files directly from the input ISO and replays the input ISO's
+    boot setup (El Torito, MBR, GPT and EFI), so neither a full extraction of
+    the ISO nor its MBR data is required. This requires xorriso 1.5.4 or
+    newer, see xorriso_supports_patching().
+
+    The given filesystem name written into the modified ISO appears when
+    the ISO gets mounted. It may only contain alphanumeric characters,
+    hyphens, underscores or periods.
+
+    Source: https://wiki.debian.org/RepackBootableISO#In_xorriso_load_ISO_tree_and_write_modified_new_ISO
 
     Parameters
     ----------
-    path_to_output_iso_file : str or pathlike object
-        Path to which the resulting ISO file will be saved.
-    path_to_input_iso_file : str or pathlike object
-        Path to the origin ISO file.
-    input_file_paths : list containing str or pathlike objects
-        A list of paths to the input files.
-    printer : clibella.Printer
-        A printer for CLI output.
+    path_to_output_iso : str or pathlike object
+        Path to the file as which the created ISO file will be saved.
+    path_to_input_iso : str or pathlike object
+        Path to the original ISO file, which is left unchanged.
+    path_to_overlay_dir : str or pathlike object
+        Path to the directory containing the files to add or replace.
+    created_iso_filesystem_name : str
+        Name of the filesystem which the created ISO will have upon
+        mounting it.
+    removed_iso_paths : list containing str
+        Paths of files or directories to remove from the ISO, relative to the
+        ISO's root directory.
+
+    Raises
+    ------
+    RuntimeError
+        Raised if the ISO patching process fails or the installed xorriso
+        is too old.
+    NotADirectoryError
+        Raised if the specified overlay directory does not exist or is not a
+        directory.
+    FileNotFoundError
+        Raised if the input ISO does not exist or is not a file.
+    FileExistsError
+        Raised if the output file already exists.
+
+    Examples
+    --------
+    patch_iso("/tmp/debian-11.0.4-modified.iso",
+        "/tmp/debian-11.0.4-netinst.iso",
+        "/tmp/isofiles",
+        "Debian 11.0.4 installation image",
+        ["install.amd/xen"])
+
     """
 
-    # verify and resolve paths
-    if "~" in str(path_to_input_iso_file):
-        path_to_input_iso_file = Path(path_to_input_iso_file).expanduser()
-    path_to_input_iso_file = Path(path_to_input_iso_file).resolve()
-    if not path_to_input_iso_file.is_file():
-        raise FileNotFoundError(f"No such file: '{path_to_input_iso_file}'.")
+    path_to_output_iso = Path(path_to_output_iso).expanduser().resolve()
+    path_to_input_iso = Path(path_to_input_iso).expanduser().resolve()
+    path_to_overlay_dir = Path(path_to_overlay_dir).expanduser().resolve()
 
-    if "~" in str(path_to_output_iso_file):
-        path_to_output_iso_file = Path(path_to_output_iso_file).expanduser()
-    path_to_output_iso_file = Path(path_to_output_iso_file).resolve()
-    if path_to_output_iso_file.is_file():
-        raise FileExistsError(f"Output file exists: '{path_to_output_iso_file}'.")
-    if not path_to_output_iso_file.parent.is_dir():
-        raise NotADirectoryError(f"No such directory: '{path_to_output_iso_file.parent}'.")
+    # make sure output file does not exist yet
+    if path_to_output_iso.exists():
+        raise FileExistsError(f"Existing file would get overwritten: "
+                              f"'{path_to_output_iso}'.")
 
-    if printer is None:
-        p = Printer()
-    else:
-        if not isinstance(printer, Printer):
-            raise TypeError(f"Expected a {type(Printer)} object.")
-        p = printer
+    # make sure input files exist
+    if not path_to_input_iso.is_file():
+        raise FileNotFoundError(f"No such file: '{path_to_input_iso}'.")
+    if not path_to_overlay_dir.is_dir():
+        raise NotADirectoryError(f"No such directory: "
+                                 f"'{path_to_overlay_dir}'.")
+
+    # make sure specified filesystem name contains no illegal characters
+    _assert_filesystem_name_is_valid(created_iso_filesystem_name)
+
+    # make sure xorriso can replay the input ISO's boot setup
+    if not xorriso_supports_patching():
+        raise RuntimeError(
+            f"Patching ISOs requires xorriso "
+            f"{'.'.join(map(str, _XORRISO_MIN_PATCHING_VERSION))} or newer."
+        )
+
+    # NOTE unlike -rm_r, -find does not fail for paths missing from the ISO
+    remove_args = []
+    for removed_iso_path in removed_iso_paths:
+        remove_args += [
+            "-find", "/", "-wholename", f"/{str(removed_iso_path).strip('/')}",
+            "-exec", "rm_r", "--",
+        ]
+
+    # patch the ISO using xorriso
+    # NOTE the mkisofs_r action applies the same ownership and permissions as
+    # the '-r' option of repack_iso(), e.g. the overlay dir's mode 0700 would
+    # otherwise be carried onto the ISO's root directory
+    try:
+        subprocess.run(
+            [
+                _XORRISO_EXECUTABLE,
+                "-indev", path_to_input_iso,
+                "-outdev", path_to_output_iso,
+                "-boot_image", "any", "replay",
+                "-volid", created_iso_filesystem_name,
+                "-joliet", "on",
+                # like repack_iso()'s '-joliet-long', as the names of the
+                # input ISO's files are not known in advance
+                "-compliance", "joliet_long_names",
+                *remove_args,
+                "-map", path_to_overlay_dir, "/",
+                "-find", "/", "-exec", "mkisofs_r", "--",
+            ],
+            capture_output=True,
+            check=True,
+            close_fds=False,
+        )
+
+    except subprocess.CalledProcessError:
+        raise RuntimeError(f"Failed while patching ISO: "
+                           f"'{path_to_input_iso}'.")
+
+
+def _set_write_permission(path, writable, recursive=False):
+    """Adds or removes the owner's write permission on the path.
+
+    Equivalent to 'chmod +w' or 'chmod -w' respectively. If recursive is
+    True and the path is a directory, everything under it is modified too.
+    """
+
+    paths = [Path(path)]
+    if recursive and paths[0].is_dir():
+        for dirpath, dirnames, filenames in os.walk(paths[0]):
+            paths += [Path(dirpath)/name for name in dirnames + filenames]
+
+    for subpath in paths:
+        mode = subpath.stat().st_mode
+        if writable:
+            subpath.chmod(mode | stat.S_IWUSR)
+        else:
+            subpath.chmod(mode & ~stat.S_IWUSR)
+
+
+def _replace_placeholders(paths_to_files, replacements):
+    """Replaces all occurrences of each placeholder within the text files.
+
+    The replacements are given as a dict mapping each placeholder to the
+    string it gets replaced with. All placeholders are substituted in a single
+    pass over each file, and the files are processed in parallel.
+    """
+
+    placeholder_regex = re.compile(
+        "|".join(re.escape(placeholder) for placeholder in replacements)
+    )
+
+    def replace_placeholders_in_file(path_to_file):
+        path_to_file = Path(path_to_file)
+        path_to_file.write_text(
+            placeholder_regex.sub(
+                lambda match: replacements[match.group()],
+                path_to_file.read_text(),
+            )
+        )
+
+    with ThreadPoolExecutor() as executor:
+        # consume the results to propagate exceptions
+        list(executor.map(replace_placeholders_in_file, paths_to_files))
+
+
+def _get_tmpfs_dir(required_space):
+    """Returns a tmpfs-backed directory with enough free space, if any.
+
+    Temporary files created in a tmpfs never get written to disk. /dev/shm
+    is preferred, $XDG_RUNTIME_DIR is used as a fallback. Returns None if
+    neither exists or has at least required_space bytes of free space,
+    making TemporaryDirectory fall back to its default location.
+    """
+
+    candidates = [Path("/dev/shm")]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        candidates.append(Path(os.environ["XDG_RUNTIME_DIR"]))
+
+    for candidate in candidates:
+        if (candidate.is_dir() and os.access(candidate, os.W_OK)
+                and shutil.disk_usage(candidate).free > required_space):
+            return str(candidate)
+
+    return None
+
+
+def _append_logo_to_initrd_archive(path_to_initrd_archive, temp_dir_location):
+    """Appends the injected logo to the initrd, as the installer's logo."""
+
+    # This stuff gotta go into the initrd with cpio trick etc
+    temp_file_dir = TemporaryDirectory(dir=temp_dir_location)
+    path_to_graphics_dir = Path(temp_file_dir.name)/"usr"/"share"/"graphics"
+    path_to_graphics_dir.mkdir(parents=True)
+    shutil.copy("./files_to_inject/logo.png", path_to_graphics_dir/"logo_debian.png")
+    append_file_contents_to_initrd_archive(
+        path_to_initrd_archive,
+        temp_file_dir.name,
+        "usr/share/graphics/logo_debian.png"
+    )
+    temp_file_dir.cleanup()
+
+
+def _inject_files_by_repacking(
+        path_to_output_iso_file,
+        path_to_input_iso_file,
+        iso_filesystem_name,
+        arch,
+        replacements,
+        p,
+):
+    """Injects the files by extracting and repacking the whole input ISO."""
+
+    # the extracted ISO takes up as much space as the ISO itself
+    temp_dir_location = _get_tmpfs_dir(path_to_input_iso_file.stat().st_size)
 
     # extract image file to a temporary directory
-    temp_extracted_iso_dir = TemporaryDirectory()
+    temp_extracted_iso_dir = TemporaryDirectory(dir=temp_dir_location)
     path_to_extracted_iso_dir = Path(temp_extracted_iso_dir.name)
     p.info(f"Extracting contents of {path_to_input_iso_file.name}...")
     extract_iso(
@@ -472,7 +950,7 @@ def inject_files_into_iso(
 
     # extract ISO MBR into a temporary directory
     p.info(f"Extracting MBR from {path_to_input_iso_file.name}...")
-    temp_mbr_dir = TemporaryDirectory()
+    temp_mbr_dir = TemporaryDirectory(dir=temp_dir_location)
     path_to_mbr_dir = Path(temp_mbr_dir.name)
     path_to_mbr_file = path_to_mbr_dir/"mbr.bin"
     extract_mbr_from_iso(
@@ -481,43 +959,42 @@ def inject_files_into_iso(
     )
     p.ok("MBR extraction complete.")
 
-    arch = "amd" if "amd64" in path_to_input_iso_file.name else "386"
-    dist = "bookworm" if "debian-12" in path_to_input_iso_file.name else "bullseye"
-    testing = "testing" if dist == "bookworm" else ""
-
     # For some reason this 'xen' thing takes up an extra 50-70ish MB compared
     # to the original iso ... not sure to understand ... but doesn't seem to be
     # actually used anywhere so let's get rid of it to save space ...
-    os.system(f"chmod +w '{path_to_extracted_iso_dir}/install.{arch}'")
-    os.system(f"chmod -R +w '{path_to_extracted_iso_dir}/install.{arch}/xen'")
-    os.system(f"rm -rf '{path_to_extracted_iso_dir}/install.{arch}/xen'")
-    os.system(f"chmod -w '{path_to_extracted_iso_dir}/install.{arch}'")
+    path_to_install_dir = path_to_extracted_iso_dir/f"install.{arch}"
+    _set_write_permission(path_to_install_dir, True)
+    if (path_to_install_dir/"xen").is_dir():
+        _set_write_permission(path_to_install_dir/"xen", True, recursive=True)
+        shutil.rmtree(path_to_install_dir/"xen")
+    _set_write_permission(path_to_install_dir, False)
 
     # Add the input files to the extracted ISO
-    os.system(f"chmod +w {path_to_extracted_iso_dir}/boot/grub")
-    os.system(f"chmod +w {path_to_extracted_iso_dir}/boot/grub/grub.cfg")
-    os.system(f"chmod +w {path_to_extracted_iso_dir}/boot/grub/theme")
-    os.system(f"chmod -R +w {path_to_extracted_iso_dir}/isolinux")
-
-    os.system(f"cp -r ./files_to_inject/* {path_to_extracted_iso_dir}/")
-    os.system(f'sed "s@__ARCH__@{arch}@g" -i "{path_to_extracted_iso_dir}/isolinux/menu.cfg"')
-    os.system(f'sed "s@__DIST__@{dist}@g" -i "{path_to_extracted_iso_dir}/preseeds/"*')
-    os.system(f'sed "s@__TESTING__@{testing}@g" -i "{path_to_extracted_iso_dir}/preseeds/"*')
-
-    os.system(f"chmod -w {path_to_extracted_iso_dir}/boot/grub")
-    os.system(f"chmod -w -R {path_to_extracted_iso_dir}/boot/grub/theme")
-    os.system(f"chmod -w {path_to_extracted_iso_dir}/boot/grub/grub.cfg")
-    os.system(f"chmod -R -w {path_to_extracted_iso_dir}/isolinux")
-    os.system(f"chmod -R -w {path_to_extracted_iso_dir}/preseeds")
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub", True)
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub"/"grub.cfg", True)
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub"/"theme", True)
+    _set_write_permission(path_to_extracted_iso_dir/"isolinux", True, recursive=True)
 
-    # This stuff gotta go into the initrd with cpio trick etc
-    temp_file_dir = TemporaryDirectory()
-    os.system(f"mkdir -p {temp_file_dir.name}/usr/share/graphics/")
-    os.system(f"cp ./files_to_inject/logo.png {temp_file_dir.name}/usr/share/graphics/logo_debian.png")
-    append_file_contents_to_initrd_archive(
-        path_to_extracted_iso_dir/f"install.{arch}"/"gtk"/"initrd.gz",
-        temp_file_dir.name,
-        "usr/share/graphics/logo_debian.png"
+    shutil.copytree(
+        "./files_to_inject", path_to_extracted_iso_dir, dirs_exist_ok=True
+    )
+    _replace_placeholders(
+        [
+            path_to_extracted_iso_dir/"isolinux"/"menu.cfg",
+            *(path_to_extracted_iso_dir/"preseeds").iterdir(),
+        ],
+        replacements,
+    )
+
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub", False)
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub"/"theme", False, recursive=True)
+    _set_write_permission(path_to_extracted_iso_dir/"boot"/"grub"/"grub.cfg", False)
+    _set_write_permission(path_to_extracted_iso_dir/"isolinux", False, recursive=True)
+    _set_write_permission(path_to_extracted_iso_dir/"preseeds", False, recursive=True)
+
+    _append_logo_to_initrd_archive(
+        path_to_install_dir/"gtk"/"initrd.gz",
+        temp_dir_location,
     )
 
     # regenerate extracted ISO's md5sum.txt file
@@ -533,9 +1010,175 @@ def inject_files_into_iso(
         path_to_extracted_iso_dir,
         iso_filesystem_name
     )
-    p.success(f"ISO file was created successfully at '{path_to_output_iso_file}'.")
 
     # clear out temporary directories
-    temp_file_dir.cleanup()
     temp_mbr_dir.cleanup()
     temp_extracted_iso_dir.cleanup()
+
+
+def _inject_files_by_patching(
+        path_to_output_iso_file,
+        path_to_input_iso_file,
+        iso_filesystem_name,
+        arch,
+        replacements,
+        p,
+):
+    """Injects the files by patching them into a copy of the input ISO."""
+
+    path_to_initrd_in_iso = f"install.{arch}/gtk/initrd.gz"
+
+    # For some reason this 'xen' thing takes up an extra 50-70ish MB compared
+    # to the original iso ... not sure to understand ... but doesn't seem to be
+    # actually used anywhere so let's get rid of it to save space ...
+    removed_iso_paths = [f"install.{arch}/xen"]
+
+    # collect all added or modified files in an overlay directory, laid out
+    # like the ISO's root directory
+    p.info("Preparing files to inject...")
+    # the overlay only holds the files to inject plus the initrd and
+    # md5sum.txt extracted from the ISO
+    temp_dir_location = _get_tmpfs_dir(
+        sum(
+            subpath.stat().st_size
+            for subpath in find_all_files_under("./files_to_inject")
+        )
+        + _PATCHED_ISO_FILES_MAX_SIZE
+    )
+    temp_overlay_dir = TemporaryDirectory(dir=temp_dir_location)
+    path_to_overlay_dir = Path(temp_overlay_dir.name)
+    shutil.copytree("./files_to_inject", path_to_overlay_dir, dirs_exist_ok=True)
+    _replace_placeholders(
+        [
+            path_to_overlay_dir/"isolinux"/"menu.cfg",
+            *(path_to_overlay_dir/"preseeds").iterdir(),
+        ],
+        replacements,
+    )
+
+    # only the files which need to be modified are extracted from the ISO
+    p.info(f"Extracting initrd and md5sum.txt from {path_to_input_iso_file.name}...")
+    extract_files_from_iso(
+        path_to_overlay_dir,
+        path_to_input_iso_file,
+        ["md5sum.txt", path_to_initrd_in_iso],
+    )
+    p.ok("Extraction complete.")
+
+    _append_logo_to_initrd_archive(
+        path_to_overlay_dir/path_to_initrd_in_iso,
+        temp_dir_location,
+    )
+
+    # update the ISO's md5sum.txt file for the modified files only
+    p.info("Updating MD5 checksums...")
+    update_iso_md5sums_file(
+        path_to_overlay_dir/"md5sum.txt",
+        path_to_overlay_dir,
+        removed_iso_paths,
+    )
+    p.ok("MD5 calculations complete.")
+
+    # write the modified ISO
+    p.info("Writing modified ISO...")
+    patch_iso(
+        path_to_output_iso_file,
+        path_to_input_iso_file,
+        path_to_overlay_dir,
+        iso_filesystem_name,
+        removed_iso_paths,
+    )
+
+    # clear out temporary directory
+    temp_overlay_dir.cleanup()
+
+
+def inject_files_into_iso(
+        path_to_output_iso_file,
+        path_to_input_iso_file,
+        iso_filesystem_name="Debian",
+        printer=None,
+        patch=False,
+):
+    """Injects the specified input files into the specified ISO file.
+
+    By default, extracts the input ISO into a temporary directory, then
+    extracts the input ISO's MBR into a temporary file, then appends the
+    input files to the extracted ISO's initrd, then regenerates the extracted
+    ISO's internal MD5 hash list and finally repacks the extracted ISO into
+    the output ISO.
+
+    If patch is True, only the input ISO's initrd and md5sum.txt are
+    extracted instead, the input files are appended to the initrd, md5sum.txt
+    is updated for the changed files and the output ISO is written by
+    patching the changed files into a copy of the input ISO. This requires
+    xorriso 1.5.4 or newer, the ISO is repacked if xorriso is older.
+
+    The input ISO file itself is left unchanged.
+    The output ISO file is newly created.
+
+    Parameters
+    ----------
+    path_to_output_iso_file : str or pathlike object
+        Path to which the resulting ISO file will be saved.
+    path_to_input_iso_file : str or pathlike object
+        Path to the origin ISO file.
+    iso_filesystem_name : str
+        Name of the filesystem which the created ISO will have upon
+        mounting it.
+    printer : clibella.Printer
+        A printer for CLI output.
+    patch : bool
+        Whether to patch a copy of the input ISO instead of repacking it.
+    """
+
+    # verify and resolve paths
+    path_to_input_iso_file = Path(path_to_input_iso_file).expanduser().resolve()
+    if not path_to_input_iso_file.is_file():
+        raise FileNotFoundError(f"No such file: '{path_to_input_iso_file}'.")
+
+    path_to_output_iso_file = Path(path_to_output_iso_file).expanduser().resolve()
+    if path_to_output_iso_file.is_file():
+        raise FileExistsError(f"Output file exists: '{path_to_output_iso_file}'.")
+    if not path_to_output_iso_file.parent.is_dir():
+        raise NotADirectoryError(f"No such directory: '{path_to_output_iso_file.parent}'.")
+
+    if printer is None:
+        p = Printer()
+    else:
+        if not isinstance(printer, Printer):
+            raise TypeError(f"Expected a {type(Printer)} object.")
+        p = printer
+
+    arch = "amd" if "amd64" in path_to_input_iso_file.name else "386"
+    dist = "bookworm" if "debian-12" in path_to_input_iso_file.name else "bullseye"
+    testing = "testing" if dist == "bookworm" else ""
+    replacements = {"__ARCH__": arch, "__DIST__": dist, "__TESTING__": testing}
+
+    if patch and not xorriso_supports_patching():
+        p.warning(
+            f"Patching ISOs requires xorriso "
+            f"{'.'.join(map(str, _XORRISO_MIN_PATCHING_VERSION))} or newer, "
+            f"repacking the ISO instead."
+        )
+        patch = False
+
+    if patch:
+        _inject_files_by_patching(
+            path_to_output_iso_file,
+            path_to_input_iso_file,
+            iso_filesystem_name,
+            arch,
+            replacements,
+            p,
+        )
+    else:
+        _inject_files_by_repacking(
+            path_to_output_iso_file,
+            path_to_input_iso_file,
+            iso_filesystem_name,
+            arch,
+            replacements,
+            p,
+        )
+    p.success(f"ISO file was created successfully at '{path_to_output_iso_file}'.")
@@ -32,9 +32,7 @@ def download_file(
         A clibella.Printer used to print CLI output.
     """
 
-    if '~' in str(path_to_output_file):
-        path_to_output_file = Path(path_to_output_file).expanduser()
-    path_to_output_file = Path(path_to_output_file).resolve()
+    path_to_output_file = Path(path_to_output_file).expanduser().resolve()
 
     if not path_to_output_file.parent.is_dir():
         raise FileNotFoundError(
@@ -25,10 +25,7 @@ def main():
 
     # parse and verify output file if sepcified
     if args.path_to_output_file:
-        path_to_output_file = Path(args.path_to_output_file)
-        if "~" in str(path_to_output_file):
-            path_to_output_file = path_to_output_file.expanduser()
-        path_to_output_file = path_to_output_file.resolve()
+        path_to_output_file = Path(args.path_to_output_file).expanduser().resolve()
 
         if path_to_output_file.exists():
             p.error(f"Output file already exists: '{path_to_output_file}'.")
@@ -38,10 +35,7 @@ def main():
 
     # parse and verify output dir if sepcified
     if args.path_to_output_dir:
-        path_to_output_dir = Path(args.path_to_output_dir)
-        if "~" in str(path_to_output_dir):
-            path_to_output_dir = path_to_output_dir.expanduser()
-        path_to_output_dir = path_to_output_dir.resolve()
+        path_to_output_dir = Path(args.path_to_output_dir).expanduser().resolve()
 
         if not path_to_output_dir.is_dir():
             p.error(f"No such directory: '{path_to_output_dir}'.")
@@ -114,10 +108,7 @@ def main():
         # verify image file path if set by user or download fresh iso if unset
         temp_iso_dir = None
         if args.path_to_image_file:
-            path_to_image_file = Path(args.path_to_image_file)
-            if "~" in str(path_to_image_file):
-                path_to_image_file = Path(path_to_image_file).expanduser()
-            path_to_image_file = Path(path_to_image_file).resolve()
+            path_to_image_file = Path(args.path_to_image_file).expanduser().resolve()
             if not path_to_image_file.is_file():
                 p.error(f"No such file: '{path_to_image_file}'.")
                 exit(1)
@@ -134,6 +125,7 @@ def main():
             path_to_image_file,
             iso_filesystem_name="YunoHost install image",
             printer=p,
+            patch=args.patch,
         )
 
         # clear out temporary directory if one was created earlier